@@ -2,62 +2,106 @@
 """
 GPT 기반 비용 분석 모듈 (B 역할)
 - analyze_cost_with_gpt(cost_rows: List[Dict]) -> str
-- build_prompt(cost_rows) -> str
+- pick_model(rows, anomaly) -> str  (이상 징후 여부에 따른 모델 선택)
+- build_prompt(cost_rows, verbose=False) -> str
+- analyze_cost_with_gpt_async(cost_rows) -> str  (asyncio용 비동기 버전)
+- analyze_cost_with_gpt_batch(cost_rows, urgent=False) -> str  (Batch API 제출)
+- collect_batch_results() -> List[str]  (이전 주기에 제출한 Batch 결과 수거)
 
 요구:
 - OPENAI_API_KEY 환경변수에서 키를 읽음
-- 모델: gpt-4.1-mini (경량)
+- 모델: 이상 징후 시 gpt-4.1-mini, 평시 gpt-4.1-nano (pick_model)
 """
 
 import os
+import io
+import csv
 import json
-import statistics
-from typing import List, Dict
+import time
+import hashlib
+import logging
+from functools import lru_cache
+from datetime import datetime
+from typing import List, Dict, Any, Optional
+
+import httpx  # openai SDK의 HTTP 백엔드 (SDK 의존성으로 항상 설치됨, 커넥션 풀 설정용)
+import numpy as np
+
+try:
+    # orjson: 표준 json 대비 직렬화/파싱이 수 배 빠름 (없으면 표준 json으로 대체)
+    import orjson
+except ImportError:
+    orjson = None
 
 try:
     # 최신 OpenAI Python SDK 사용법 가정
-    from openai import OpenAI
+    from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
 except Exception as e:
     raise RuntimeError("openai 라이브러리가 필요합니다. requirements.txt에 openai를 추가하고 설치하세요.") from e
 
+logger = logging.getLogger(__name__)
 
-def build_prompt(cost_rows: List[Dict]) -> str:
+# 모델 라우팅: 이상 징후가 있으면 MODEL, 평시(quiet)에는 더 저렴한 QUIET_MODEL
+MODEL = "gpt-4.1-mini"
+QUIET_MODEL = "gpt-4.1-nano"
+# pick_model 이상 추정 기준: 일자별 합계가 전일 대비 이 배율 이상 증가
+ANOMALY_RATIO = 1.5
+MAX_OUTPUT_TOKENS = 800
+# OpenAI HTTP 클라이언트: 최대/keep-alive 커넥션 수, 요청 타임아웃(재시도 시 대기 누적 방지)
+HTTP_MAX_CONNECTIONS = 100
+HTTP_MAX_KEEPALIVE = 10
+HTTP_TIMEOUT_SECONDS = 30
+# build_prompt 사전 집계: 상위 서비스 수, 이상치 표준점수 기준
+TOP_N_SERVICES = 10
+OUTLIER_Z = 2.0
+# 프롬프트에 넣는 비용 숫자의 소수 자릿수
+COST_DECIMALS = 4
+# 제출 후 아직 결과를 수거하지 않은 Batch 작업 목록 (폴링 주기 간 유지)
+BATCH_STATE_PATH = "ai_batch_pending.json"
+# GPT 응답 디스크 캐시: 같은 비용 데이터(+모델)면 TTL 동안 API 호출 없이 재사용
+# AI_CACHE_DIR 환경변수로 변경 가능. Lambda에서는 배포 경로(/var/task)가 읽기 전용이므로 /tmp 아래를 사용
+_ON_LAMBDA = bool(os.getenv("AWS_LAMBDA_FUNCTION_NAME"))
+AI_CACHE_DIR = os.getenv("AI_CACHE_DIR") or (
+    os.path.join("/tmp", "ai_cache") if _ON_LAMBDA else os.path.join(".cache", "ai")
+)
+AI_CACHE_TTL_SECONDS = 6 * 60 * 60
+
+
+def _dumps(obj, indent: bool = False, sort_keys: bool = False) -> str:
     """
-    GPT에 전달할 프롬프트를 구성.
-    cost_rows 예시: [{"date": "2025-12-10", "service": "AmazonEC2", "cost": 12.34}, ...]
-    GPT가 잘 이해하도록 요약, 질문 목록, 분석 포인트를 포함한 프롬프트 문자열 반환.
+    JSON 직렬화 (orjson 우선, 한글은 그대로 UTF-8 출력, indent=False면 공백 없는 compact 형식).
+    cost에 numpy.float64 등 NumPy 값이 들어와도 표준 json처럼 직렬화되도록 OPT_SERIALIZE_NUMPY 사용.
     """
-    # 안정성: 정렬(날짜 기준) 및 JSON 직렬화
-    try:
-        rows_sorted = sorted(cost_rows, key=lambda r: r.get("date", ""))
-    except Exception:
-        rows_sorted = list(cost_rows)
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY | (orjson.OPT_INDENT_2 if indent else 0)
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, option=option).decode("utf-8")
+    if indent:
+        return json.dumps(obj, ensure_ascii=False, indent=2, sort_keys=sort_keys)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), sort_keys=sort_keys)
 
-    # 간단 통계(로컬)로 GPT에 추가 정보 제공 (추세, 평균, 표준편차)
-    costs = [float(r.get("cost", 0.0)) for r in rows_sorted if r.get("cost") is not None]
-    summary_stats = {}
-    if costs:
-        summary_stats = {
-            "count": len(costs),
-            "total": sum(costs),
-            "mean": statistics.mean(costs),
-        }
-        if len(costs) > 1:
-            summary_stats["stdev"] = statistics.pstdev(costs)  # population stdev
-        else:
-            summary_stats["stdev"] = 0.0
-    else:
-        summary_stats = {"count": 0, "total": 0.0, "mean": 0.0, "stdev": 0.0}
 
-    prompt = f"""
-당신은 AWS 비용 분석 전문가입니다. 아래는 AWS 서비스별/일자별 비용 데이터입니다.
+def _loads(data):
+    """JSON 파싱 (orjson 우선)"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# 프롬프트 캐싱용 고정 프리픽스
+# - OpenAI는 1024 토큰 이상 동일한 프리픽스를 자동 캐싱(이후 128 토큰 단위)하므로,
+#   역할/규칙/포맷 안내처럼 매번 같은 내용은 앞쪽에 두고 실행마다 달라지는 데이터는 맨 뒤에 붙인다.
+# - 캐시 최소 길이(1024 토큰)를 넘기도록 작성 가이드와 예시를 함께 포함한다.
+_STATIC_PREFIX = """
+당신은 AWS 비용 분석 전문가입니다. 이 프롬프트의 마지막에 AWS 서비스별/일자별 비용 데이터가 주어집니다.
 목표: 한국어로 이해하기 쉬운 비용 분석 리포트를 만드세요. 포맷은 자유지만 아래 항목을 반드시 포함하세요:
   1) 이상 비용(Anomaly) 감지: 어떤 서비스/일자에서 평소보다 급증 또는 급감했는지 식별하고, 근거(숫자 비교: 전일 대비, 평균 대비 등)를 함께 표기하세요.
   2) 전체 추세 요약: 최근 기간의 총 비용 추세(증가/감소/안정)와 주요 원인으로 추정되는 서비스들을 요약하세요.
   3) 추가 확인 항목 제안: 운영팀이 확인해야 할 구체적인 액션 아이템(예: 특정 로그/리소스 확인, 예약 인스턴스/스팟 사용 확인, S3 데이터 전송량 점검 등).
   4) (선택) 비용 절감 아이디어가 있으면 간략히 제안하세요.
 
-입력 데이터(정렬된 JSON)와 간단 통계는 아래에 포함됩니다. 숫자는 한국어로 설명하되, 중요한 수치는 괄호안에 원본 숫자를 포함하세요.
+입력 데이터(사전 집계된 CSV 표)와 간단 통계는 맨 아래에 포함됩니다. 숫자는 한국어로 설명하되, 중요한 수치는 괄호안에 원본 숫자를 포함하세요.
 
 간단한 포맷 제안(권장):
 - 요약(1-2문장)
@@ -66,61 +110,307 @@ def build_prompt(cost_rows: List[Dict]) -> str:
 - 권장 확인 항목(번호 목록)
 - 비용 절감 아이디어(선택)
 
-아래는 데이터와 간단 통계입니다.
+입력 데이터 설명 (비용 단위는 모두 USD, UnblendedCost 기준, date는 YYYY-MM-DD):
+- DAILY_TOTALS: 일자별 전체 비용 합계입니다. 열: date,total
+- TOP_SERVICES: 기간 합계 기준 상위 서비스입니다. service는 Cost Explorer의 SERVICE 차원 값
+  (예: Amazon Elastic Compute Cloud - Compute, Amazon Simple Storage Service)이며,
+  열: service,total,mean,stdev,first,last (first/last는 기간 첫날/마지막 날 비용)
+- OUTLIER_ROWS: 서비스별 평균에서 표준편차의 2배 이상 벗어난 일자/서비스 레코드입니다.
+  열: date,service,cost,z (z는 해당 서비스 기준 표준점수). 해당 레코드가 없으면 헤더만 표시됩니다.
+- COST_ROWS_JSON: 디버깅용으로만 포함되는 원본 레코드(date, service, cost)이며, 대부분의 경우 생략됩니다.
+- SUMMARY_STATS: 전체 레코드에 대해 로컬에서 미리 계산한 통계입니다. count(레코드 수), total(비용 합계),
+  mean(레코드당 평균 비용), stdev(모집단 표준편차)를 포함합니다. 이상치 판단 시 참고 기준으로 활용하세요.
 
-=== COST_ROWS_JSON START ===
-{json.dumps(rows_sorted, ensure_ascii=False, indent=2)}
-=== COST_ROWS_JSON END ===
+분석 가이드:
+- 이상 비용 판단 기준: 같은 서비스의 전일 대비 1.5배 이상 증가하거나 절반 이하로 감소한 경우,
+  또는 평균에서 표준편차의 2배 이상 벗어난 경우를 우선 이상치 후보로 보세요. 기준에 딱 맞지 않더라도
+  금액 규모가 커서 전체 비용에 큰 영향을 주는 변화라면 함께 언급하세요.
+- 금액이 매우 작은 서비스(예: 0.01 USD 미만)의 비율 변화는 노이즈일 가능성이 높으므로 이상치로 과도하게 강조하지 마세요.
+- 새로 등장한 서비스(이전 일자에는 없다가 새로 비용이 발생한 서비스)와 사라진 서비스는 별도로 표기하세요.
+- 추세를 설명할 때는 기간 전체의 총액 변화와 상위 비용 서비스의 비중 변화를 함께 설명하세요.
+- 원인 추정 시에는 서비스 특성을 고려하세요. 예를 들어 EC2는 인스턴스 수/타입 변경이나 오토스케일링,
+  S3는 저장 용량 증가나 요청/데이터 전송량 증가, RDS는 인스턴스 크기 변경이나 스토리지/백업 증가,
+  Data Transfer는 리전 간 전송이나 인터넷 아웃바운드 증가, CloudWatch는 로그 수집량이나 커스텀 메트릭 증가,
+  Lambda는 호출 횟수나 실행 시간 증가, NAT Gateway는 처리 데이터량 증가가 흔한 원인입니다.
+- 권장 확인 항목은 운영팀이 바로 실행할 수 있도록 구체적으로 작성하세요. 확인할 콘솔 메뉴, 비교할 지표,
+  점검할 리소스 종류를 함께 적고, 우선순위가 높은 항목부터 번호를 매기세요.
+- 비용 절감 아이디어는 데이터에서 근거를 찾을 수 있는 경우에만 제안하고, 일반론은 한두 줄로 제한하세요.
+  (예: 예약 인스턴스/Savings Plans 검토, 스팟 인스턴스 활용, 미사용 EBS 볼륨/스냅샷 정리, S3 수명 주기 정책 적용,
+  로그 보존 기간 단축, 유휴 리소스 중지 등)
+- 데이터가 하루치뿐이거나 레코드가 비어 있는 경우에는 비교가 불가능하다는 점을 명시하고,
+  현재 비용 구성(상위 서비스와 비중) 위주로 요약하세요.
 
-=== SUMMARY_STATS START ===
-{json.dumps(summary_stats, ensure_ascii=False, indent=2)}
-=== SUMMARY_STATS END ===
+출력 예시(형식 참고용, 수치는 예시이며 실제 데이터로 대체해야 함):
+요약: 최근 3일간 총 비용은 증가 추세이며, 주로 EC2 비용 상승(전일 대비 약 1.8배)이 원인으로 추정됩니다.
+주요 이상치:
+- 2025-12-11 Amazon Elastic Compute Cloud - Compute: 전일 대비 약 1.8배 증가 (5.1200 → 9.2300 USD)
+- 2025-12-11 Amazon Simple Storage Service: 평균 대비 크게 증가 (평균 0.4100, 당일 1.3500 USD)
+추세 및 원인:
+  전체 비용은 하루 평균 약 10 USD 수준에서 15 USD 수준으로 증가했습니다. EC2가 전체 비용의 약 60%를 차지하며,
+  신규 인스턴스 추가 또는 인스턴스 타입 변경이 있었을 가능성이 있습니다(추정).
+권장 확인 항목:
+  1. EC2 콘솔에서 2025-12-11 전후로 새로 시작된 인스턴스와 오토스케일링 활동 기록 확인
+  2. S3 버킷별 요청 수와 데이터 전송량(CloudWatch 지표) 점검
+  3. Cost Explorer에서 사용 유형(USAGE_TYPE)별로 다시 그룹화하여 증가 항목 세분화
+비용 절감 아이디어(선택):
+  - 상시 구동 인스턴스가 있다면 Savings Plans 또는 예약 인스턴스 적용 검토
 
 주의:
 - 분석은 주어진 데이터만 기반하여 추정으로 제시하세요. (확인 필요 시 '추정'이라고 표기)
 - 결과는 한국어로 출력하세요.
-"""
-    return prompt.strip()
 
+아래는 데이터와 간단 통계입니다.
+""".lstrip()
+
+# 프롬프트 전체 템플릿: 고정 프리픽스 + 가변 데이터 자리(placeholder) 2개
+# 모듈 로드 시 한 번만 만들고 build_prompt에서는 format_map으로 값만 채운다
+# (프리픽스에 중괄호가 들어가도 깨지지 않도록 이스케이프)
+_TEMPLATE = _STATIC_PREFIX.replace("{", "{{").replace("}", "}}") + """
+{rows_json}
+
+=== SUMMARY_STATS START ===
+{stats_json}
+=== SUMMARY_STATS END ==="""
+
+
+def _csv_block(name: str, header: List[str], rows: List[List[Any]]) -> str:
+    """이름 있는 CSV 블록 문자열 (=== NAME START === ... === NAME END ===)"""
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    writer.writerow(header)
+    writer.writerows(rows)
+    return f"=== {name} START ===\n{buf.getvalue()}=== {name} END ==="
 
-def analyze_cost_with_gpt(cost_rows: List[Dict]) -> str:
+
+def _aggregate(rows_sorted: List[Dict]) -> Dict[str, List[List[Any]]]:
     """
-    주어진 cost_rows를 GPT로 분석 요청하고, 한국어 분석 리포트를 문자열로 반환.
+    전체 레코드 대신 GPT에 보낼 요약 표 생성 (입력 토큰 절감).
+    - daily: 일자별 합계
+    - top: 기간 합계 상위 TOP_N_SERVICES개 서비스의 합계/평균/표준편차/첫날/마지막 날 비용
+    - outliers: 서비스별 |z| > OUTLIER_Z 인 레코드
     """
-    OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-    if not OPENAI_API_KEY:
-        return ("[AI 분석 실패] OPENAI_API_KEY 환경변수가 설정되어 있지 않습니다. "
-                "환경변수를 설정한 뒤 다시 시도하세요.")
+    daily: Dict[str, float] = {}
+    by_service: Dict[str, List[Dict]] = {}
+    for r in rows_sorted:
+        if r.get("cost") is None:
+            continue
+        cost = float(r["cost"])
+        date = r.get("date", "")
+        daily[date] = daily.get(date, 0.0) + cost
+        by_service.setdefault(r.get("service", ""), []).append(r)
 
-    prompt = build_prompt(cost_rows)
+    top = []
+    outliers = []
+    for service, rows in by_service.items():
+        arr = np.fromiter((float(r["cost"]) for r in rows), dtype=np.float64, count=len(rows))
+        mean = arr.mean()
+        std = arr.std()
+        top.append([service, arr.sum(), mean, std, arr[0], arr[-1]])
+        if std > 0:
+            z = (arr - mean) / std
+            for i in np.flatnonzero(np.abs(z) > OUTLIER_Z):
+                outliers.append([rows[i].get("date", ""), service, arr[i], z[i]])
 
-    # OpenAI 클라이언트 초기화 (최신 SDK 가정)
-    try:
-        client = OpenAI(api_key=OPENAI_API_KEY)
-    except TypeError:
-        # 일부 SDK 버전에서는 OpenAI()만 써야할 수 있음
-        client = OpenAI()
-        # client.api_key = OPENAI_API_KEY  # 보통은 생성자에서 처리되나 환경변수 reliance 가능
+    top.sort(key=lambda t: t[1], reverse=True)
+    outliers.sort(key=lambda o: o[0])
+    # 비용은 COST_DECIMALS 자리, 표준점수는 소수 둘째 자리로 반올림 (숫자당 토큰 수 절감)
+    return {
+        "daily": [[d, round(t, COST_DECIMALS)] for d, t in sorted(daily.items())],
+        "top": [[t[0]] + [round(float(v), COST_DECIMALS) for v in t[1:]] for t in top[:TOP_N_SERVICES]],
+        "outliers": [[o[0], o[1], round(float(o[2]), COST_DECIMALS), round(float(o[3]), 2)] for o in outliers],
+    }
 
-    # 호출: responses API 사용 가정
+
+class _RowsKey:
+    """
+    build_prompt lru_cache 키. dict 리스트는 해시할 수 없으므로
+    cost_rows의 canonical JSON(blake2b digest)으로 해시/비교하고, 원본 rows는 계산용으로만 들고 있는다.
+    """
+    __slots__ = ("digest", "rows")
+
+    def __init__(self, rows: List[Dict]):
+        self.rows = rows
+        self.digest = hashlib.blake2b(_dumps(rows, sort_keys=True).encode("utf-8"), digest_size=16).digest()
+
+    def __hash__(self) -> int:
+        return hash(self.digest)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, _RowsKey) and self.digest == other.digest
+
+
+def build_prompt(cost_rows: List[Dict], verbose: bool = False) -> str:
+    """
+    GPT에 전달할 프롬프트를 구성.
+    cost_rows 예시: [{"date": "2025-12-10", "service": "AmazonEC2", "cost": 12.34}, ...]
+    고정 프리픽스(_STATIC_PREFIX) 뒤에 실행마다 달라지는 데이터/통계를 붙여 프롬프트 캐시가 적중하도록 한다.
+    데이터는 일자별 합계/상위 서비스/이상치 레코드의 CSV 표로 압축하며,
+    verbose=True면 디버깅용으로 원본 레코드(COST_ROWS_JSON)도 함께 포함한다.
+    같은 비용 데이터로 다시 호출하면(새 데이터 없이 연속 폴링 등) 캐시된 프롬프트를 그대로 반환.
+    """
+    return _build_prompt_cached(_RowsKey(cost_rows), verbose)
+
+
+@lru_cache(maxsize=8)
+def _build_prompt_cached(key: _RowsKey, verbose: bool) -> str:
+    cost_rows = key.rows
+    # 안정성: 정렬(날짜 기준) 및 JSON 직렬화
     try:
-        # responses.create의 반환 형식이 SDK 버전에 따라 다를 수 있으므로 안전하게 처리
-        response = client.responses.create(
-            model="gpt-4.1-mini",
-            input=prompt,
-            max_tokens=800  # 적당한 분량
+        rows_sorted = sorted(cost_rows, key=lambda r: r.get("date", ""))
+    except Exception:
+        rows_sorted = list(cost_rows)
+    # 비용을 COST_DECIMALS 자리로 반올림 (12.34567891234 같은 긴 숫자의 토큰 수를 줄이고,
+    # 미세한 값 변화로 프롬프트가 달라지지 않게 함)
+    rows_sorted = [
+        {**r, "cost": round(float(r["cost"]), COST_DECIMALS)} if r.get("cost") is not None else r
+        for r in rows_sorted
+    ]
+
+    # 간단 통계(로컬)로 GPT에 추가 정보 제공 (추세, 평균, 표준편차)
+    # NumPy 배열 한 번 생성 후 C 레벨 reduction으로 합계/평균/표준편차 계산
+    costs = np.fromiter(
+        (float(r["cost"]) for r in rows_sorted if r.get("cost") is not None),
+        dtype=np.float64,
+    )
+    if costs.size:
+        summary_stats = {
+            "count": int(costs.size),
+            "total": round(float(costs.sum()), COST_DECIMALS),
+            "mean": round(float(costs.mean()), COST_DECIMALS),
+            "stdev": round(float(costs.std()), COST_DECIMALS) if costs.size > 1 else 0.0,  # population stdev
+        }
+    else:
+        summary_stats = {"count": 0, "total": 0.0, "mean": 0.0, "stdev": 0.0}
+
+    agg = _aggregate(rows_sorted)
+    blocks = [
+        _csv_block("DAILY_TOTALS", ["date", "total"], agg["daily"]),
+        _csv_block("TOP_SERVICES", ["service", "total", "mean", "stdev", "first", "last"], agg["top"]),
+        _csv_block("OUTLIER_ROWS", ["date", "service", "cost", "z"], agg["outliers"]),
+    ]
+    # JSON은 들여쓰기 없이 compact하게 넣어 공백 토큰을 줄이고, 구분선은 JSON 밖에 둔다
+    if verbose:
+        blocks.append(
+            "=== COST_ROWS_JSON START ===\n"
+            f"{_dumps(rows_sorted)}\n"
+            "=== COST_ROWS_JSON END ==="
         )
-    except Exception as e:
-        return f"[AI 분석 실패] OpenAI API 호출 중 오류가 발생했습니다: {e}"
 
-    # 응답 텍스트 추출 (여러 SDK 호환성 고려)
+    # 가변 데이터는 항상 프롬프트 끝에 위치 (프리픽스가 바뀌면 캐시 미적중)
+    return _TEMPLATE.format_map({
+        "rows_json": "\n\n".join(blocks),
+        "stats_json": _dumps(summary_stats),
+    }).strip()
+
+
+def _field(obj, name: str):
+    # SDK 응답 객체와 Batch 결과의 dict 응답 본문을 같은 방식으로 조회
+    if isinstance(obj, dict):
+        return obj.get(name)
+    return getattr(obj, name, None)
+
+
+def get_cached_tokens(response) -> int:
+    """
+    응답 usage에서 프롬프트 캐시 적중 토큰 수를 추출 (SDK/API 버전별 필드명 차이 고려).
+    캐시가 적중하지 않았거나 정보가 없으면 0.
+    """
+    usage = _field(response, "usage")
+    if usage is None:
+        return 0
+    for name in ("input_tokens_details", "prompt_tokens_details"):
+        details = _field(usage, name)
+        if details is not None:
+            return _field(details, "cached_tokens") or 0
+    return 0
+
+
+def _log_cache_usage(response, model: str) -> None:
+    """실제 분석 호출마다 프롬프트 캐시 적중 여부(cached_tokens)를 기록"""
+    usage = _field(response, "usage")
+    if usage is None:
+        return
+    logger.info("prompt cache: model=%s input_tokens=%s cached_tokens=%d",
+                model, _field(usage, "input_tokens"), get_cached_tokens(response))
+
+
+_CLIENT = None
+_ASYNC_CLIENT = None
+
+
+def _http_limits() -> "httpx.Limits":
+    # DefaultHttpxClient/DefaultAsyncHttpxClient는 SDK 기본값(타임아웃, 리다이렉트 등)을 유지한 채
+    # 커넥션 풀 설정만 바꿀 수 있음
+    return httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE)
+
+
+def _get_client(api_key: str):
+    """
+    OpenAI 클라이언트 lazy 싱글톤 (최신 SDK 가정).
+    호출마다 새로 만들면 httpx 커넥션 풀/TLS 연결을 매번 다시 맺으므로 모듈 단위로 재사용.
+    """
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = OpenAI(
+            api_key=api_key,
+            timeout=HTTP_TIMEOUT_SECONDS,
+            http_client=DefaultHttpxClient(limits=_http_limits()),
+        )
+    return _CLIENT
+
+
+def _get_async_client(api_key: str):
+    """AsyncOpenAI 클라이언트 lazy 싱글톤 (asyncio 루프에서 사용)"""
+    global _ASYNC_CLIENT
+    if _ASYNC_CLIENT is None:
+        _ASYNC_CLIENT = AsyncOpenAI(
+            api_key=api_key,
+            timeout=HTTP_TIMEOUT_SECONDS,
+            http_client=DefaultAsyncHttpxClient(limits=_http_limits()),
+        )
+    return _ASYNC_CLIENT
+
+
+def pick_model(rows: List[Dict], anomaly: Optional[bool] = None) -> str:
+    """
+    이상 징후 여부에 따라 분석 모델 선택.
+    anomaly를 모르면(None) rows에서 추정: 서비스별 이상치(OUTLIER_ROWS)가 있거나
+    일자별 합계가 전일 대비 ANOMALY_RATIO배 이상 증가한 날이 있으면 이상으로 본다.
+    모든 모델이 같은 _STATIC_PREFIX를 쓰므로 모델별 프롬프트 캐시는 그대로 적중한다.
+    """
+    if anomaly is None:
+        agg = _aggregate(rows)
+        daily = [t for _, t in agg["daily"]]
+        anomaly = bool(agg["outliers"]) or any(
+            prev > 0 and cur / prev >= ANOMALY_RATIO for prev, cur in zip(daily, daily[1:])
+        )
+    return MODEL if anomaly else QUIET_MODEL
+
+
+def _request_body(prompt: str, model: str) -> Dict[str, Any]:
+    """responses API 요청 본문 (동기 호출과 Batch 요청이 동일한 본문을 사용)"""
+    return {
+        "model": model,
+        "input": prompt,
+        "max_output_tokens": MAX_OUTPUT_TOKENS,  # 적당한 분량
+    }
+
+
+def _response_text(response) -> Optional[str]:
+    """
+    응답 텍스트 추출 (여러 SDK 호환성 고려). 텍스트가 없으면 None.
+    SDK 응답 객체와 Batch 결과 파일의 dict 형태 응답 본문을 모두 처리.
+    """
     ai_text = None
     try:
         # 최신 responses API: response.output[0].content[0].text 또는 response.output_text
         if hasattr(response, "output_text"):
             ai_text = response.output_text
         else:
-            out = getattr(response, "output", None)
+            if isinstance(response, dict):
+                out = response.get("output")
+            else:
+                out = getattr(response, "output", None)
             if out and isinstance(out, list) and len(out) > 0:
                 # 합쳐서 텍스트 생성
                 parts = []
@@ -133,14 +423,335 @@ def analyze_cost_with_gpt(cost_rows: List[Dict]) -> str:
                         elif isinstance(c, str):
                             parts.append(c)
                 ai_text = "\n".join(parts).strip() if parts else None
-
-        # 마지막 안전망
-        if not ai_text:
-            ai_text = str(response)
     except Exception:
-        ai_text = str(response)
+        ai_text = None
+    return ai_text or None
+
 
+_REPORT_HEADER = "=== GPT 기반 비용 분석 리포트 ===\n"
+_REPORT_FOOTER = "\n=== 리포트 끝 ==="
+
+
+def _format_report(ai_text: str) -> str:
     # 최종 포맷: 간단한 헤더 + 본문
-    header = "=== GPT 기반 비용 분석 리포트 ===\n"
-    footer = "\n=== 리포트 끝 ==="
-    return header + ai_text + footer
+    return _REPORT_HEADER + ai_text + _REPORT_FOOTER
+
+
+def _emit(text: str, stream: bool) -> str:
+    """stream 모드에서는 반환하는 문자열을 바로 출력 (stream 모드 결과는 항상 출력된 상태가 되도록)"""
+    if stream:
+        print(text, flush=True)
+    return text
+
+
+class _StreamInterrupted(Exception):
+    """스트리밍 도중 실패. partial에는 실패 전까지 받은(이미 출력된) 본문 + 실패 안내가 담긴다."""
+
+    def __init__(self, partial: str):
+        super().__init__(partial)
+        self.partial = partial
+
+
+def _print_delta(event, parts: List[str]) -> None:
+    if event.type == "response.output_text.delta":
+        parts.append(event.delta)
+        print(event.delta, end="", flush=True)
+
+
+def _interrupted(parts: List[str], error: Exception) -> _StreamInterrupted:
+    parts.append(f"\n[AI 분석 중단] 스트리밍 도중 오류가 발생해 리포트가 완전하지 않습니다: {error}")
+    print(parts[-1], end="", flush=True)
+    return _StreamInterrupted("".join(parts))
+
+
+def _stream_response(client, body: Dict[str, Any]):
+    """
+    responses.stream으로 생성되는 텍스트 조각을 받는 즉시 stdout에 출력하고, 최종 응답 객체를 반환.
+    사용자는 전체 생성 시간이 아니라 첫 토큰 도착 시점부터 리포트를 볼 수 있다.
+    도중에 실패하면 실패 안내를 덧붙여 _StreamInterrupted로 알리고, 리포트 끝 표시는 항상 출력한다.
+    """
+    parts: List[str] = []
+    print(_REPORT_HEADER, end="", flush=True)
+    try:
+        with client.responses.stream(**body) as stream:
+            for event in stream:
+                _print_delta(event, parts)
+            return stream.get_final_response()
+    except Exception as e:
+        raise _interrupted(parts, e) from e
+    finally:
+        print(_REPORT_FOOTER, flush=True)
+
+
+async def _stream_response_async(client, body: Dict[str, Any]):
+    """_stream_response()의 비동기 버전"""
+    parts: List[str] = []
+    print(_REPORT_HEADER, end="", flush=True)
+    try:
+        async with client.responses.stream(**body) as stream:
+            async for event in stream:
+                _print_delta(event, parts)
+            return await stream.get_final_response()
+    except Exception as e:
+        raise _interrupted(parts, e) from e
+    finally:
+        print(_REPORT_FOOTER, flush=True)
+
+
+def _response_cache_key(cost_rows: List[Dict], model: str) -> str:
+    """정렬된 cost_rows의 canonical JSON + 모델명 기준 sha256 (행 순서/키 순서와 무관)"""
+    rows_sorted = sorted(cost_rows, key=lambda r: (str(r.get("date", "")), str(r.get("service", ""))))
+    canonical = _dumps(rows_sorted, sort_keys=True)
+    return hashlib.sha256(f"{model}\n{canonical}".encode("utf-8")).hexdigest()
+
+
+def _read_response_cache(key: str) -> Optional[str]:
+    """캐시된 분석 본문 반환 (없거나 TTL이 지났으면 None)"""
+    path = os.path.join(AI_CACHE_DIR, f"{key}.txt")
+    try:
+        if time.time() - os.path.getmtime(path) > AI_CACHE_TTL_SECONDS:
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _write_response_cache(key: str, ai_text: str) -> None:
+    try:
+        os.makedirs(AI_CACHE_DIR, exist_ok=True)
+        with open(os.path.join(AI_CACHE_DIR, f"{key}.txt"), "w", encoding="utf-8") as f:
+            f.write(ai_text)
+    except OSError as e:
+        # 캐시 저장 실패는 분석 결과에 영향 없음 (단, 캐시가 동작하지 않으므로 기록은 남김)
+        logger.warning("GPT 응답 캐시 저장 실패 (%s): %s", AI_CACHE_DIR, e)
+
+
+_MISSING_KEY_MESSAGE = ("[AI 분석 실패] OPENAI_API_KEY 환경변수가 설정되어 있지 않습니다. "
+                        "환경변수를 설정한 뒤 다시 시도하세요.")
+
+
+def _start_analysis(
+    cost_rows: List[Dict],
+    model: Optional[str],
+    anomaly: Optional[bool],
+    stream: bool,
+):
+    """
+    동기/비동기/Batch 분석 공통 준비: API 키 확인, 모델 선택, 응답 캐시 조회, 요청 본문 생성.
+    (early, model, cache_key, body) 반환. early가 있으면(API 키 없음, 캐시 적중) API 호출 없이 그대로 반환한다.
+    """
+    if not os.getenv("OPENAI_API_KEY"):
+        return _emit(_MISSING_KEY_MESSAGE, stream), None, None, None
+    model = model or pick_model(cost_rows, anomaly)
+    cache_key = _response_cache_key(cost_rows, model)
+    cached = _read_response_cache(cache_key)
+    if cached is not None:
+        return _emit(_format_report(cached), stream), None, None, None
+    return None, model, cache_key, _request_body(build_prompt(cost_rows), model)
+
+
+def _finish_analysis(response, model: str, cache_key: Optional[str]) -> str:
+    """
+    API/Batch 응답에서 본문을 꺼내 리포트로 포맷.
+    완료(status=completed)되고 실제 텍스트가 있는 응답만 캐시한다
+    (빈 응답, max_output_tokens로 잘린 incomplete 응답은 TTL 동안 재사용되지 않도록).
+    """
+    _log_cache_usage(response, model)
+    ai_text = _response_text(response)
+    if cache_key and ai_text and _field(response, "status") == "completed":
+        _write_response_cache(cache_key, ai_text)
+    # 마지막 안전망: 텍스트가 없으면 응답 객체 문자열을 그대로 표시
+    return _format_report(ai_text or str(response))
+
+
+def _analysis_failed(error: Exception, stream: bool) -> str:
+    if isinstance(error, _StreamInterrupted):
+        # 부분 리포트는 이미 출력됨. 불완전한 결과이므로 캐시하지 않는다
+        return _format_report(error.partial)
+    return _emit(f"[AI 분석 실패] OpenAI API 호출 중 오류가 발생했습니다: {error}", stream)
+
+
+def analyze_cost_with_gpt(
+    cost_rows: List[Dict],
+    model: Optional[str] = None,
+    anomaly: Optional[bool] = None,
+    stream: bool = False,
+) -> str:
+    """
+    주어진 cost_rows를 GPT로 분석 요청하고, 한국어 분석 리포트를 문자열로 반환.
+    model을 지정하지 않으면 pick_model(cost_rows, anomaly)로 선택.
+    stream=True면 생성되는 리포트를 stdout으로 바로 출력하면서 받는다 (반환값도 출력된 상태).
+    """
+    early, model, cache_key, body = _start_analysis(cost_rows, model, anomaly, stream)
+    if early is not None:
+        return early
+
+    client = _get_client(os.getenv("OPENAI_API_KEY"))
+    # 호출: responses API 사용 가정
+    try:
+        response = _stream_response(client, body) if stream else client.responses.create(**body)
+    except Exception as e:
+        return _analysis_failed(e, stream)
+    return _finish_analysis(response, model, cache_key)
+
+
+async def analyze_cost_with_gpt_async(
+    cost_rows: List[Dict],
+    model: Optional[str] = None,
+    anomaly: Optional[bool] = None,
+    stream: bool = False,
+) -> str:
+    """
+    analyze_cost_with_gpt()의 비동기 버전 (AsyncOpenAI 사용).
+    asyncio 모니터링 루프에서 비용 조회 등 다른 네트워크 작업과 겹쳐 실행할 수 있다.
+    stream=True면 생성되는 리포트를 stdout으로 바로 출력하면서 받는다 (반환값도 출력된 상태).
+    """
+    early, model, cache_key, body = _start_analysis(cost_rows, model, anomaly, stream)
+    if early is not None:
+        return early
+
+    client = _get_async_client(os.getenv("OPENAI_API_KEY"))
+    try:
+        if stream:
+            response = await _stream_response_async(client, body)
+        else:
+            response = await client.responses.create(**body)
+    except Exception as e:
+        return _analysis_failed(e, stream)
+    return _finish_analysis(response, model, cache_key)
+
+
+# =====================================
+# Batch API (비긴급 분석, 입력/출력 토큰 50% 할인)
+# =====================================
+def _load_pending_batches() -> List[Dict[str, Any]]:
+    try:
+        with open(BATCH_STATE_PATH, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    try:
+        pending = _loads(data)
+    except ValueError:
+        # 손상된 상태 파일로 모니터링이 멈추지 않도록 비어 있는 것으로 취급
+        logger.warning("Batch 상태 파일을 읽을 수 없어 무시합니다: %s", BATCH_STATE_PATH)
+        return []
+    return pending if isinstance(pending, list) else []
+
+
+def _save_pending_batches(pending: List[Dict[str, Any]]) -> None:
+    # 임시 파일에 쓴 뒤 교체 (쓰는 도중 중단돼도 잘린 JSON이 남지 않음)
+    tmp = BATCH_STATE_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(_dumps(pending, indent=True))
+    os.replace(tmp, BATCH_STATE_PATH)
+
+
+def analyze_cost_with_gpt_batch(
+    cost_rows: List[Dict],
+    urgent: bool = False,
+    model: Optional[str] = None,
+    anomaly: Optional[bool] = None,
+) -> str:
+    """
+    cost_rows 분석 요청을 Batch API로 제출하고, 제출 상태 메시지를 반환.
+    결과는 즉시 나오지 않으며(최대 24시간), 제출한 batch ID를 BATCH_STATE_PATH에 저장해
+    다음 폴링 주기에 collect_batch_results()로 수거한다.
+    urgent=True면 Batch를 거치지 않고 analyze_cost_with_gpt()로 즉시 분석 리포트를 반환.
+    """
+    if urgent:
+        return analyze_cost_with_gpt(cost_rows, model=model, anomaly=anomaly)
+
+    early, model, cache_key, body = _start_analysis(cost_rows, model, anomaly, stream=False)
+    if early is not None:
+        return early
+
+    # 같은 데이터(+모델)로 제출한 batch가 아직 대기 중이면 중복 제출하지 않음
+    pending = _load_pending_batches()
+    for entry in pending:
+        if entry.get("cache_key") == cache_key:
+            return (f"[AI 분석 대기] 같은 데이터의 Batch 작업이 이미 진행 중입니다 "
+                    f"(batch_id={entry.get('batch_id')}). 다음 주기에 결과를 확인합니다.")
+
+    custom_id = f"rca-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+    line = {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/responses",
+        "body": body,
+    }
+    jsonl = (_dumps(line) + "\n").encode("utf-8")
+
+    client = _get_client(os.getenv("OPENAI_API_KEY"))
+    try:
+        input_file = client.files.create(file=(f"{custom_id}.jsonl", jsonl), purpose="batch")
+        batch = client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/responses",
+            completion_window="24h",
+        )
+    except Exception as e:
+        return f"[AI 분석 실패] Batch 제출 중 오류가 발생했습니다: {e}"
+
+    pending.append({"batch_id": batch.id, "custom_id": custom_id, "cache_key": cache_key})
+    _save_pending_batches(pending)
+    return f"[AI 분석 대기] Batch 작업이 제출되었습니다 (batch_id={batch.id}). 다음 주기에 결과를 확인합니다."
+
+
+def collect_batch_results() -> List[str]:
+    """
+    저장된 대기 중 batch들의 상태를 batches.retrieve로 확인하고,
+    완료된 작업의 분석 리포트 목록을 반환. 아직 진행 중인 batch는 다음 호출로 넘긴다.
+    """
+    pending = _load_pending_batches()
+    if not pending:
+        return []
+
+    OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+    if not OPENAI_API_KEY:
+        return []
+    client = _get_client(OPENAI_API_KEY)
+
+    reports = []
+    still_pending = []
+    for entry in pending:
+        try:
+            batch = client.batches.retrieve(entry["batch_id"])
+        except Exception:
+            still_pending.append(entry)
+            continue
+
+        if batch.status in ("failed", "expired", "cancelled"):
+            reports.append(f"[AI 분석 실패] Batch 작업이 종료되었습니다 "
+                           f"(batch_id={batch.id}, status={batch.status}).")
+            continue
+        if batch.status != "completed":
+            still_pending.append(entry)
+            continue
+
+        file_id = batch.output_file_id or batch.error_file_id
+        try:
+            content = client.files.content(file_id).text
+        except Exception as e:
+            reports.append(f"[AI 분석 실패] Batch 결과 다운로드 중 오류가 발생했습니다: {e}")
+            continue
+
+        for raw in content.splitlines():
+            if not raw.strip():
+                continue
+            try:
+                result = _loads(raw)
+            except ValueError:
+                reports.append(f"[AI 분석 실패] Batch 결과를 해석할 수 없습니다 (batch_id={batch.id}).")
+                continue
+            resp = result.get("response") or {}
+            if result.get("error") or resp.get("status_code") != 200:
+                reports.append(f"[AI 분석 실패] Batch 요청 오류 ({result.get('custom_id')}): "
+                               f"{result.get('error') or resp.get('body')}")
+                continue
+            body = resp.get("body", {})
+            reports.append(_finish_analysis(body, body.get("model", ""), entry.get("cache_key")))
+
+    _save_pending_batches(still_pending)
+    return reports
@@ -1,30 +1,91 @@
+import asyncio
+import aioboto3
 import boto3
 import botocore
-import time
+import botocore.config
+import errno
 import os
-import json
+import sys
+import logging
+from dataclasses import dataclass, field
+from functools import lru_cache
+from operator import itemgetter
+from pathlib import Path
 from datetime import datetime, timedelta
-from typing import Tuple, Optional, Dict, Any
+from typing import Tuple, Optional, Dict, Any, List
+
+import numpy as np
+
+from aiobotocore.config import AioConfig
+
+# JSON 직렬화/파싱은 ai_analyzer의 orjson 우선 헬퍼를 같이 사용
+from ai_analyzer import (
+    _dumps,
+    _loads,
+    analyze_cost_with_gpt,
+    analyze_cost_with_gpt_async,
+    analyze_cost_with_gpt_batch,
+    collect_batch_results,
+)
 
 # =====================================
 # 기본 설정
 # =====================================
 CONFIG_PATH = "aws_credentials.json"
+AWS_REGION = "ap-northeast-2"
+# 이상 감지 EWMA 기준선: 평활 계수, run_once 조회 기간(일)
+EWMA_ALPHA = 0.3
+EWMA_WINDOW_DAYS = 7
+# 이미 알림/GPT 분석을 수행한 이상 징후 목록 (30분마다 같은 날짜를 다시 알리지 않도록)
+# ALERT_STATE_PATH 환경변수로 변경 가능. Lambda에서는 쓰기 가능한 /tmp를 사용하며,
+# /tmp는 웜 컨테이너 동안만 유지되므로 영구 보관이 필요하면 EFS 등 마운트 경로를 지정
+ALERT_STATE_PATH = os.getenv("ALERT_STATE_PATH") or (
+    "/tmp/alerted_anomalies.json" if os.getenv("AWS_LAMBDA_FUNCTION_NAME") else "alerted_anomalies.json"
+)
+ALERT_STATE_MAX_ENTRIES = 100
+
+# 30분 폴링 사이에도 커넥션을 유지해 매 주기 TCP/TLS 핸드셰이크를 피하고,
+# 스로틀링 시 adaptive 재시도로 백오프 (동기 boto3 / aioboto3 클라이언트 공통 설정)
+CE_CLIENT_CONFIG_KWARGS = dict(
+    region_name=AWS_REGION,
+    tcp_keepalive=True,
+    max_pool_connections=10,
+    retries={"max_attempts": 5, "mode": "adaptive"},
+    connect_timeout=5,
+    read_timeout=30,
+)
+CE_CLIENT_CONFIG = botocore.config.Config(**CE_CLIENT_CONFIG_KWARGS)
 
 # =====================================
 # AWS 크레덴셜 관리 + 비용 조회
 # =====================================
 def save_credentials(access_key: str, secret_key: str) -> None:
     data = {"AWS_ACCESS_KEY": access_key, "AWS_SECRET_KEY": secret_key}
-    with open(CONFIG_PATH, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=4)
+    payload = _dumps(data, indent=True).encode("utf-8")  # orjson 유무와 관계없이 2칸 들여쓰기
+    # 임시 파일에 한 번에 쓴 뒤 교체 (쓰는 도중 중단돼도 기존 파일이 잘린 JSON으로 남지 않음)
+    path = Path(CONFIG_PATH)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_bytes(payload)
+    os.replace(tmp, path)
     print(f"\n✔ 자격 증명이 '{CONFIG_PATH}' 파일에 저장되었습니다.")
 
 def load_credentials() -> Optional[Dict[str, Any]]:
-    if not os.path.exists(CONFIG_PATH):
+    # exists() 확인 없이 바로 열기 (syscall 1회, TOCTOU 없음), 심볼릭 링크는 따라가지 않음
+    try:
+        fd = os.open(CONFIG_PATH, os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0))
+    except FileNotFoundError:
         return None
-    with open(CONFIG_PATH, "r", encoding="utf-8") as f:
-        return json.load(f)
+    except OSError as e:
+        # O_NOFOLLOW: 심볼릭 링크면 ELOOP (일부 BSD는 EMLINK)
+        if e.errno in (errno.ELOOP, errno.EMLINK):
+            print(f"\n[ERROR] '{CONFIG_PATH}'이(가) 심볼릭 링크입니다. "
+                  "보안을 위해 자격 증명 파일은 심볼릭 링크를 따라가지 않습니다. 실제 파일로 교체한 뒤 다시 실행하세요.")
+        else:
+            print(f"\n[ERROR] 자격 증명 파일 '{CONFIG_PATH}'을(를) 열 수 없습니다: {e}")
+        sys.exit(1)
+    with os.fdopen(fd, "rb") as f:
+        data = f.read()
+    return _loads(data)
 
 def get_or_create_credentials() -> Tuple[str, str]:
     creds = load_credentials()
@@ -40,58 +101,135 @@ def get_or_create_credentials() -> Tuple[str, str]:
     save_credentials(access_key, secret_key)
     return access_key, secret_key
 
-def create_ce_client(access_key: str, secret_key: str):
-    session = boto3.Session(
+@lru_cache(maxsize=None)
+def create_default_ce_client():
+    # Lambda 등에서 실행 역할(IAM Role) 기본 자격 증명 체인을 사용
+    # (웜 컨테이너의 연속 호출 간에는 같은 클라이언트/커넥션 풀을 재사용)
+    return boto3.client("ce", config=CE_CLIENT_CONFIG)
+
+def create_async_ce_client(access_key: str, secret_key: str):
+    # aioboto3 클라이언트는 async context manager로 사용: async with create_async_ce_client(...) as ce:
+    session = aioboto3.Session(
         aws_access_key_id=access_key,
         aws_secret_access_key=secret_key,
-        region_name="ap-northeast-2",
+        region_name=AWS_REGION,
+    )
+    return session.client("ce", config=AioConfig(**CE_CLIENT_CONFIG_KWARGS))
+
+def _cost_query(start_date: str, end_date: str) -> Dict[str, Any]:
+    return dict(
+        TimePeriod={"Start": start_date, "End": end_date},
+        Granularity="DAILY",
+        Metrics=["UnblendedCost"],
+        GroupBy=[{"Type": "DIMENSION", "Key": "SERVICE"}],
     )
-    return session.client("ce")
 
 def fetch_cost(ce_client, start_date: str, end_date: str):
     try:
-        response = ce_client.get_cost_and_usage(
-            TimePeriod={"Start": start_date, "End": end_date},
-            Granularity="DAILY",
-            Metrics=["UnblendedCost"],
-            GroupBy=[{"Type": "DIMENSION", "Key": "SERVICE"}],
-        )
+        response = ce_client.get_cost_and_usage(**_cost_query(start_date, end_date))
         return response
     except botocore.exceptions.ClientError as e:
         print("\n[ERROR] AWS API 호출 실패:")
         print(e)
         return None
 
+async def fetch_cost_async(ce_client, start_date: str, end_date: str):
+    try:
+        return await ce_client.get_cost_and_usage(**_cost_query(start_date, end_date))
+    except botocore.exceptions.ClientError as e:
+        print("\n[ERROR] AWS API 호출 실패:")
+        print(e)
+        return None
+
+# Cost Explorer Groups 항목 접근자 (루프마다 다시 만들지 않도록 모듈 단위로 한 번 생성)
+_get_keys = itemgetter("Keys")
+_get_metrics = itemgetter("Metrics")
+
+def _group_services(groups: List[Dict[str, Any]]) -> List[str]:
+    return [_get_keys(g)[0] for g in groups]
+
+def _group_amounts(groups: List[Dict[str, Any]]) -> List[float]:
+    # 그룹별 UnblendedCost 금액(문자열)을 한 번의 comprehension으로 float 변환
+    return [float(_get_metrics(g)["UnblendedCost"]["Amount"]) for g in groups]
+
 def print_cost_table(response) -> None:
-    print("\n===== AWS 비용 결과 =====")
+    # 표 전체를 모아 한 번에 출력 (줄마다 print/flush하지 않음)
+    lines = ["", "===== AWS 비용 결과 ====="]
     results = response.get("ResultsByTime", [])
     for day in results:
         date = day["TimePeriod"]["Start"]
-        print(f"\n📅 날짜: {date}")
-        print("----------------------------------")
-        for g in day.get("Groups", []):
-            service = g["Keys"][0]
-            amount = g["Metrics"]["UnblendedCost"]["Amount"]
-            print(f"{service:<35} {float(amount):.4f} USD")
-        print("----------------------------------")
+        groups = day.get("Groups", [])
+        lines.append("")
+        lines.append(f"📅 날짜: {date}")
+        lines.append("----------------------------------")
+        lines.extend(
+            f"{service:<35} {amount:.4f} USD"
+            for service, amount in zip(_group_services(groups), _group_amounts(groups))
+        )
+        lines.append("----------------------------------")
+    sys.stdout.write("\n".join(lines) + "\n")
+
+def to_cost_rows(response) -> List[Dict[str, Any]]:
+    """Cost Explorer 응답을 AI 분석용 date/service/cost 레코드 리스트로 변환"""
+    rows = []
+    for day in response.get("ResultsByTime", []):
+        date = day["TimePeriod"]["Start"]
+        groups = day.get("Groups", [])
+        rows.extend(
+            {"date": date, "service": service, "cost": amount}
+            for service, amount in zip(_group_services(groups), _group_amounts(groups))
+        )
+    return rows
 
 # =====================================
 # 비용 이상징후 감지 + 콘솔 알림
 # =====================================
-def calculate_total_cost(response):
+def calculate_total_cost(response, index: int = 0):
+    # index: ResultsByTime 중 합계를 계산할 일자 (기본값: 첫째 날, -1이면 마지막 날)
     results = response.get("ResultsByTime", [])
     if not results:
         return 0.0
-    day = results[0]
-    total = 0.0
-    for g in day.get("Groups", []):
-        total += float(g["Metrics"]["UnblendedCost"]["Amount"])
-    return total
-
-def detect_anomaly(cost_today: float, cost_yesterday: float, threshold: float = 1.5) -> bool:
-    if cost_yesterday == 0:
+    groups = results[index].get("Groups", [])
+    amounts = np.fromiter(_group_amounts(groups), dtype=np.float64, count=len(groups))
+    return float(amounts.sum())
+
+class EwmaBaseline:
+    """
+    일별 비용의 지수가중이동평균(EWMA) 기준선.
+    전일 한 번의 값과 비교하는 것보다 노이즈에 덜 민감해 오탐(→ 불필요한 GPT 분석 호출)이 줄어든다.
+    update()에 date를 넘기면 이미 반영한 날짜(또는 그 이전)는 무시해, 같은 날을 여러 번 조회해도 하루 한 번만 반영된다.
+    """
+    def __init__(self, alpha: float = EWMA_ALPHA):
+        self.alpha = alpha
+        self._ewma: Optional[float] = None
+        self.last_date: Optional[str] = None
+
+    @property
+    def value(self) -> Optional[float]:
+        return self._ewma
+
+    def update(self, cost: float, date: Optional[str] = None) -> Optional[float]:
+        if date is not None:
+            if self.last_date is not None and date <= self.last_date:
+                return self._ewma
+            self.last_date = date
+        if self._ewma is None:
+            self._ewma = cost
+        else:
+            self._ewma = self.alpha * cost + (1 - self.alpha) * self._ewma
+        return self._ewma
+
+def detect_anomaly(
+    cost_today: float,
+    cost_yesterday: float,
+    threshold: float = 1.5,
+    baseline: Optional[float] = None,
+) -> bool:
+    # baseline(EWMA)이 있으면 기준선 대비, 없으면 기존처럼 전일 대비로 판단
+    reference = baseline if baseline is not None else cost_yesterday
+    if reference == 0:
         return False
-    return cost_today / cost_yesterday >= threshold
+    return cost_today / reference >= threshold
 
 def send_alert(message: str):
     print("\n[ALERT] 비용 이상 감지!")
@@ -99,36 +237,209 @@ def send_alert(message: str):
     print("[✔] 알림 완료!")
 
 # =====================================
-# 메인 루프
+# 이벤트 기반 실행 (EventBridge Scheduler / Cost Anomaly Detection → Lambda)
 # =====================================
-def main() -> None:
+@dataclass
+class AnomalyEvent:
+    date: str
+    today_cost: float
+    prev_cost: float
+    baseline: Optional[float] = None
+    cost_rows: List[Dict[str, Any]] = field(default_factory=list)
+
+    @property
+    def increase(self) -> float:
+        reference = self.baseline if self.baseline is not None else self.prev_cost
+        return self.today_cost / reference if reference else 0.0
+
+    def message(self) -> str:
+        if self.baseline is not None:
+            comparison = f"기준선(EWMA {self.baseline:.4f} USD) 대비 {self.increase:.2f}배 증가"
+        else:
+            comparison = f"전일 대비 {self.increase:.2f}배 증가"
+        return (
+            f"🚨 AWS 비용 이상 감지! ({self.date})\n"
+            f"{comparison}\n"
+            f"어제: {self.prev_cost:.4f} USD → 오늘: {self.today_cost:.4f} USD"
+        )
+
+@dataclass
+class CostCheck:
+    """run_once() 1회 조회 결과: 조회 구간의 분석용 레코드 + 이상 시 AnomalyEvent (조회 실패 시 둘 다 비어 있음)"""
+    cost_rows: List[Dict[str, Any]] = field(default_factory=list)
+    anomaly: Optional[AnomalyEvent] = None
+
+def _recent_window() -> Tuple[str, str]:
+    # 집계가 끝난 최근 EWMA_WINDOW_DAYS일 (Cost Explorer End는 exclusive이므로 오늘 제외)
     end_date = datetime.now().strftime("%Y-%m-%d")
-    start_date = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
+    start_date = (datetime.now() - timedelta(days=EWMA_WINDOW_DAYS)).strftime("%Y-%m-%d")
+    return start_date, end_date
+
+def _check_costs(resp, threshold: float, baseline: Optional[EwmaBaseline]) -> CostCheck:
+    # 마지막 날 합계를 이전 날들의 EWMA 기준선과 비교 (baseline을 넘기면 새 날짜만 반영해 이어서 사용)
+    print_cost_table(resp)
+    check = CostCheck(cost_rows=to_cost_rows(resp))
+    results = resp.get("ResultsByTime", [])
+    if len(results) < 2:
+        return check
+    totals = [calculate_total_cost(resp, i) for i in range(len(results))]
+    baseline = baseline if baseline is not None else EwmaBaseline()
+    for day, total in zip(results[:-1], totals[:-1]):
+        baseline.update(total, date=day["TimePeriod"]["Start"])
+    if detect_anomaly(totals[-1], totals[-2], threshold=threshold, baseline=baseline.value):
+        check.anomaly = AnomalyEvent(
+            date=results[-1]["TimePeriod"]["Start"],
+            today_cost=totals[-1],
+            prev_cost=totals[-2],
+            baseline=baseline.value,
+            cost_rows=check.cost_rows,
+        )
+    return check
+
+def run_once(ce_client, threshold: float = 1.5, baseline: Optional[EwmaBaseline] = None) -> CostCheck:
+    """
+    1회 비용 조회 + 이상 감지. 상주 프로세스 없이 스케줄러에서 호출하는 단위.
+    집계가 끝난 최근 EWMA_WINDOW_DAYS일을 조회해 마지막 날 합계를 이전 날들의 EWMA 기준선과 비교하고,
+    이상 시 CostCheck.anomaly에 AnomalyEvent를 담아 반환.
+    baseline을 넘기지 않으면(Lambda는 실행 간 상태가 없음) 기준선을 매번 조회 기간으로 다시 계산.
+    """
+    resp = fetch_cost(ce_client, *_recent_window())
+    if not resp:
+        return CostCheck()
+    return _check_costs(resp, threshold, baseline)
+
+async def run_once_async(ce_client, threshold: float = 1.5, baseline: Optional[EwmaBaseline] = None) -> CostCheck:
+    """run_once()의 비동기 버전 (aioboto3 클라이언트, 폴링 루프에서 사용)"""
+    resp = await fetch_cost_async(ce_client, *_recent_window())
+    if not resp:
+        return CostCheck()
+    return _check_costs(resp, threshold, baseline)
+
+def _anomaly_window(message: Dict[str, Any]) -> Tuple[str, str]:
+    # Cost Anomaly Detection SNS 메시지의 anomalyStartDate/anomalyEndDate (예: 2025-12-10T00:00:00Z)
+    # 전후 하루씩 넓혀 비교 기준일을 포함하고, Cost Explorer End는 exclusive이므로 +1일
+    start = datetime.strptime(message["anomalyStartDate"][:10], "%Y-%m-%d") - timedelta(days=1)
+    end = datetime.strptime(message.get("anomalyEndDate", message["anomalyStartDate"])[:10], "%Y-%m-%d")
+    return start.strftime("%Y-%m-%d"), (end + timedelta(days=1)).strftime("%Y-%m-%d")
+
+def _load_alerted() -> List[str]:
+    try:
+        with open(ALERT_STATE_PATH, "rb") as f:
+            alerted = _loads(f.read())
+    except (OSError, ValueError):
+        return []
+    return alerted if isinstance(alerted, list) else []
+
+def _mark_alerted(key: str) -> None:
+    alerted = [k for k in _load_alerted() if k != key] + [key]
+    payload = _dumps(alerted[-ALERT_STATE_MAX_ENTRIES:]).encode("utf-8")
+    tmp = ALERT_STATE_PATH + ".tmp"
+    try:
+        Path(tmp).write_bytes(payload)
+        os.replace(tmp, ALERT_STATE_PATH)
+    except OSError as e:
+        print(f"[WARN] 알림 이력 저장 실패 ({ALERT_STATE_PATH}): {e}")
+
+def _claim_alert(key: str) -> bool:
+    # 처음 보는 이상 징후면 기록하고 True (30분마다 같은 이상 징후를 다시 알리고 분석하지 않도록)
+    if key in _load_alerted():
+        return False
+    _mark_alerted(key)
+    return True
+
+def lambda_handler(event, context) -> Dict[str, Any]:
+    """
+    Lambda 진입점.
+    - EventBridge Scheduler (cron(0,30 * * * ? *)): run_once()로 조회/감지, 이상 시에만 GPT 분석
+    - Cost Anomaly Detection SNS 알림: AWS가 감지한 이상 구간의 비용을 조회해 GPT 분석
+    같은 이상 징후(일자 / anomalyId)는 ALERT_STATE_PATH에 기록해 한 번만 알리고 분석한다.
+    """
+    ce_client = create_default_ce_client()
+    reports = []
+
+    records = event.get("Records", []) if isinstance(event, dict) else []
+    sns_records = [r for r in records if r.get("EventSource") == "aws:sns" or "Sns" in r]
+    if sns_records:
+        for record in sns_records:
+            message = _loads(record["Sns"]["Message"])
+            if not _claim_alert(f"sns:{message.get('anomalyId') or message['anomalyStartDate']}"):
+                continue
+            send_alert(f"🚨 AWS Cost Anomaly Detection 알림\n{record['Sns'].get('Subject', '')}")
+            start_date, end_date = _anomaly_window(message)
+            resp = fetch_cost(ce_client, start_date, end_date)
+            if resp:
+                reports.append(analyze_cost_with_gpt(to_cost_rows(resp), anomaly=True))
+    else:
+        anomaly = run_once(ce_client).anomaly
+        if anomaly is not None and not _claim_alert(f"daily:{anomaly.date}"):
+            print(f"\n이미 알림을 보낸 이상 징후입니다 ({anomaly.date}). 알림/분석을 생략합니다.")
+        elif anomaly is not None:
+            send_alert(anomaly.message())
+            reports.append(analyze_cost_with_gpt(anomaly.cost_rows, anomaly=True))
+
+    for report in reports:
+        print("\n" + report)
+    return {"anomalies": len(reports), "reports": reports}
+
+# =====================================
+# 메인 루프
+# =====================================
+async def analyze_cycle(cost_rows: List[Dict[str, Any]], anomaly: bool) -> None:
+    # 이전 주기에 제출한 Batch 분석 결과 출력
+    for report in await asyncio.to_thread(collect_batch_results):
+        print("\n" + report)
+    # 이상 감지 시에는 즉시(비동기) 분석, 평시에는 Batch API로 제출 후 다음 주기에 수거
+    if anomaly:
+        # 생성되는 대로 바로 출력 (stream=True는 결과를 직접 출력함)
+        print()
+        await analyze_cost_with_gpt_async(cost_rows, anomaly=True, stream=True)
+    else:
+        report = await asyncio.to_thread(analyze_cost_with_gpt_batch, cost_rows)
+        print("\n" + report)
+
+def _report_analysis_error(task: asyncio.Task) -> None:
+    # 분석 태스크가 끝나는 즉시 실패를 출력 (예외가 루프로 전파돼 모니터링이 멈추지 않도록 여기서 소비)
+    if task.cancelled():
+        return
+    exc = task.exception()
+    if exc is not None:
+        print(f"\n[ERROR] AI 분석 중 오류가 발생했습니다: {exc!r}")
+
+async def poll_loop(access_key: str, secret_key: str) -> None:
     interval_minutes = 30
 
+    # 상주 프로세스는 기준선을 주기 간 유지 (run_once_async가 새로 집계된 날만 하루 한 번 반영)
+    baseline = EwmaBaseline()
+    analysis: Optional[asyncio.Task] = None
+
+    async with create_async_ce_client(access_key, secret_key) as ce_client:
+        while True:
+            print(f"\n===== 비용 확인: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} =====")
+            # 이전 주기의 GPT 분석(analysis 태스크)이 남아 있어도 비용 조회는 바로 진행
+            # (조회 구간은 매 주기 다시 계산되므로 자정이 지나면 새로 집계가 끝난 날로 이동)
+            check = await run_once_async(ce_client, threshold=1.5, baseline=baseline)
+            if check.cost_rows:
+                # 같은 날짜의 이상 징후는 처음 감지한 주기에만 알림 + 즉시 분석
+                anomaly = check.anomaly is not None and _claim_alert(f"daily:{check.anomaly.date}")
+                if anomaly:
+                    send_alert(check.anomaly.message())
+
+                # 분석은 최대 한 건만 진행 (Batch 대기 목록 파일 동시 수정 방지)
+                # (asyncio.wait는 태스크의 예외를 다시 던지지 않음, 예외는 _report_analysis_error가 출력)
+                if analysis is not None:
+                    await asyncio.wait([analysis])
+                analysis = asyncio.create_task(analyze_cycle(check.cost_rows, anomaly))
+                analysis.add_done_callback(_report_analysis_error)
+
+            print(f"\n⏳ 다음 실행까지 {interval_minutes}분 대기...")
+            await asyncio.sleep(interval_minutes * 60)
+
+def main() -> None:
+    # ai_analyzer의 프롬프트 캐시 적중(cached_tokens) 로그를 콘솔에 표시
+    logging.basicConfig(format="[%(name)s] %(message)s")
+    logging.getLogger("ai_analyzer").setLevel(logging.INFO)
     access_key, secret_key = get_or_create_credentials()
-    ce_client = create_ce_client(access_key, secret_key)
-    prev_cost = None
-
-    while True:
-        print(f"\n===== 비용 확인: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} =====")
-        resp = fetch_cost(ce_client, start_date, end_date)
-        if resp:
-            print_cost_table(resp)
-            today_total = calculate_total_cost(resp)
-            if prev_cost is not None:
-                if detect_anomaly(today_total, prev_cost, threshold=1.5):
-                    increase = today_total / prev_cost
-                    alert_message = (
-                        f"🚨 AWS 비용 이상 감지!\n"
-                        f"전일 대비 {increase:.2f}배 증가\n"
-                        f"어제: {prev_cost:.4f} USD → 오늘: {today_total:.4f} USD"
-                    )
-                    send_alert(alert_message)
-            prev_cost = today_total
-
-        print(f"\n⏳ 다음 실행까지 {interval_minutes}분 대기...")
-        time.sleep(interval_minutes * 60)
+    asyncio.run(poll_loop(access_key, secret_key))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,169 @@
+import json
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import ai_analyzer
+
+
+ROWS = [
+    {"date": "2025-12-10", "service": "AmazonEC2", "cost": 1.5},
+    {"date": "2025-12-11", "service": "AmazonEC2", "cost": 3.0},
+]
+
+
+class FakeClient:
+    """files/batches API만 흉내내는 OpenAI 클라이언트 대역"""
+
+    def __init__(self, output_lines=None, status="completed"):
+        self.output_lines = output_lines or []
+        self.status = status
+        self.created = []
+        self.files = SimpleNamespace(create=self._create_file, content=self._content)
+        self.batches = SimpleNamespace(create=self._create_batch, retrieve=self._retrieve)
+
+    def _create_file(self, file, purpose):
+        return SimpleNamespace(id=f"file-{len(self.created)}")
+
+    def _create_batch(self, input_file_id, endpoint, completion_window):
+        batch_id = f"batch{len(self.created) + 1}"
+        self.created.append(batch_id)
+        return SimpleNamespace(id=batch_id)
+
+    def _retrieve(self, batch_id):
+        return SimpleNamespace(id=batch_id, status=self.status,
+                               output_file_id="file-out", error_file_id=None)
+
+    def _content(self, file_id):
+        return SimpleNamespace(text="\n".join(self.output_lines))
+
+
+@pytest.fixture
+def fake_env(tmp_path, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    monkeypatch.setattr(ai_analyzer, "BATCH_STATE_PATH", str(tmp_path / "pending.json"))
+    monkeypatch.setattr(ai_analyzer, "AI_CACHE_DIR", str(tmp_path / "cache"))
+
+    def install(client):
+        monkeypatch.setattr(ai_analyzer, "_get_client", lambda api_key: client)
+        return client
+
+    return install
+
+
+def _output_line(custom_id, text, status="completed"):
+    return json.dumps({
+        "custom_id": custom_id,
+        "response": {
+            "status_code": 200,
+            "body": {
+                "model": "gpt-4.1-nano",
+                "status": status,
+                "output": [{"content": [{"type": "output_text", "text": text}]}],
+                "usage": {"input_tokens": 1500, "input_tokens_details": {"cached_tokens": 1024}},
+            },
+        },
+        "error": None,
+    }, ensure_ascii=False)
+
+
+def test_collect_batch_results_parses_output_file(fake_env):
+    client = fake_env(FakeClient())
+    ai_analyzer.analyze_cost_with_gpt_batch(ROWS)
+    client.output_lines = [
+        _output_line("rca-1", "요약: 비용 증가"),
+        "",
+        json.dumps({"custom_id": "rca-2", "response": {"status_code": 500, "body": {"error": "boom"}}}),
+        "{not json",
+    ]
+
+    reports = ai_analyzer.collect_batch_results()
+
+    assert reports[0] == ai_analyzer._format_report("요약: 비용 증가")
+    assert reports[1].startswith("[AI 분석 실패] Batch 요청 오류 (rca-2)")
+    assert reports[2].startswith("[AI 분석 실패] Batch 결과를 해석할 수 없습니다")
+    assert ai_analyzer._load_pending_batches() == []
+    # 수거한 결과는 응답 캐시에 저장되어 같은 데이터로 다시 제출하지 않음
+    assert ai_analyzer.analyze_cost_with_gpt_batch(ROWS) == reports[0]
+    assert client.created == ["batch1"]
+
+
+def test_incomplete_or_empty_results_are_not_cached(fake_env):
+    client = fake_env(FakeClient())
+    ai_analyzer.analyze_cost_with_gpt_batch(ROWS)
+    client.output_lines = [_output_line("rca-1", "요약: 잘린 리포트", status="incomplete")]
+    assert ai_analyzer.collect_batch_results() == [ai_analyzer._format_report("요약: 잘린 리포트")]
+
+    # 잘린 결과는 캐시되지 않으므로 다시 제출됨
+    ai_analyzer.analyze_cost_with_gpt_batch(ROWS)
+    assert client.created == ["batch1", "batch2"]
+
+    # 텍스트 없는 응답도 캐시하지 않음
+    client.responses = SimpleNamespace(
+        create=lambda **body: SimpleNamespace(output_text="", status="completed", usage=None))
+    ai_analyzer.analyze_cost_with_gpt(ROWS)
+    assert not os.path.isdir(ai_analyzer.AI_CACHE_DIR) or not os.listdir(ai_analyzer.AI_CACHE_DIR)
+
+
+def test_collect_batch_results_keeps_in_progress_batches(fake_env):
+    fake_env(FakeClient(status="in_progress"))
+    ai_analyzer.analyze_cost_with_gpt_batch(ROWS)
+
+    assert ai_analyzer.collect_batch_results() == []
+    assert [e["batch_id"] for e in ai_analyzer._load_pending_batches()] == ["batch1"]
+
+
+def test_batch_not_resubmitted_while_pending(fake_env):
+    client = fake_env(FakeClient(status="in_progress"))
+
+    for _ in range(3):
+        ai_analyzer.analyze_cost_with_gpt_batch(ROWS)
+
+    assert client.created == ["batch1"]
+    assert len(ai_analyzer._load_pending_batches()) == 1
+
+
+def test_corrupt_state_file_is_ignored(fake_env, tmp_path):
+    fake_env(FakeClient())
+    (tmp_path / "pending.json").write_bytes(b'[{"batch_id": "bat')
+
+    assert ai_analyzer.collect_batch_results() == []
+
+
+class BrokenStream:
+    """델타 몇 개를 보낸 뒤 연결이 끊기는 responses.stream 대역"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __iter__(self):
+        yield SimpleNamespace(type="response.output_text.delta", delta="부분 ")
+        yield SimpleNamespace(type="response.output_text.delta", delta="리포트")
+        raise ConnectionError("connection reset")
+
+
+def test_stream_failure_keeps_partial_report_and_footer(fake_env, capsys):
+    fake_env(SimpleNamespace(responses=SimpleNamespace(stream=lambda **body: BrokenStream())))
+
+    report = ai_analyzer.analyze_cost_with_gpt(ROWS, stream=True)
+
+    out = capsys.readouterr().out
+    assert "부분 리포트" in report and "connection reset" in report
+    assert out.rstrip().endswith(ai_analyzer._REPORT_FOOTER.strip())
+    assert out.count(ai_analyzer._REPORT_FOOTER.strip()) == 1
+    # 불완전한 결과는 캐시하지 않음
+    cache_dir = ai_analyzer.AI_CACHE_DIR
+    assert not (os.path.isdir(cache_dir) and os.listdir(cache_dir))
+
+
+def test_numpy_costs_are_accepted():
+    rows = [{**r, "cost": np.float64(r["cost"])} for r in ROWS]
+
+    assert ai_analyzer.build_prompt(rows) == ai_analyzer.build_prompt(ROWS)
+    assert (ai_analyzer._response_cache_key(rows, ai_analyzer.MODEL)
+            == ai_analyzer._response_cache_key(ROWS, ai_analyzer.MODEL))